@@ -1,31 +1,61 @@
-import database
 import threadpool
-import gw2api
+import math
+import itertools
+from fractions import Fraction
+from collections import namedtuple
 
+# database (psycopg2) and gw2api (requests) are imported inside the functions that use 
+# them, so a lookup against a catalog snapshot never pays for the database driver
 
-def crafting_cost(item_identifier, *, debug = False):
-    ''' Creates 1 (+ 1) connections and N threads per call (N = # ingredients in base list).
+# Fraction of a trading post sale kept after the listing fee and exchange tax
+TP_FEE_FACTOR = 0.85
+
+# inputs - 'buy' (place buy orders for ingredients) or 'sell' (instant buy from sell listings)
+# exit - 'sell' (list the crafted item) or 'buy' (instant sell into buy orders)
+# input_shock/exit_shock - percent change applied to ingredient/output prices
+Scenario = namedtuple('Scenario', 'name inputs exit input_shock exit_shock')
+ScenarioRow = namedtuple('ScenarioRow', 'item_id item_name scenario craft_cost revenue roi')
+
+
+def crafting_cost(item_identifier, *, debug = False, catalog = None):
+    ''' Creates 1 connection and N threads per call (N = # ingredients in base list).
     Arguments: 'item_identifier' is either an item name or id
                
                'info' is a flag which when set forces function to return a list 
                of dictionaries with full information about ingredient costs
                Return value: [{item_id: , item_name, count:, unit_cost: ,total_cost: }, ...]
+               count and total_cost are exact (e.g. 2/3 of an ingredient when a recipe makes 3)
+
+               'catalog' is an optional catalog.Catalog snapshot, when given recipes 
+               and vendor prices are read from it and no connection is made
     '''
+    if catalog is None:
+        import database
+        with database.Gw2Database() as conn: # Connection here
+            base_ingredients = conn.base_ingredients(item_identifier)
+            vendor_prices = conn.vendor_prices() # Loaded once per process
+    else:
+        base_ingredients = catalog.base_ingredients(item_identifier)
+        vendor_prices = catalog.vendor_prices()
+
+    return _crafting_cost(item_identifier, base_ingredients, vendor_prices, debug = debug)
+
+def _crafting_cost(item_identifier, base_ingredients, vendor_prices, *, debug = False):
+    '''crafting_cost for base ingredients that were already looked up, e.g. for a whole 
+    watchlist at once (see _flatten)'''
+    import gw2api
 
-    with database.Gw2Database() as conn: # Connection here
-        base_ingredients = conn.base_ingredients(item_identifier)
-    
     def worker(ingredient_dict):
         '''Argument is a dictionary from base ingredients list.  
         Looks up the item_id against gw2 api's TP listings.
         Returns ingredient dictionary with two additional keys - 'unit_cost' and 'total_cost' '''
         
+        ingredient_dict = dict(ingredient_dict) # Lists may be shared by repeated watchlist items
         item_id = ingredient_dict['item_id']
         
         # We assume that the priority of where you buy the item from will be 
         # 1) vendor, 2) buy listings, 3) sell listings
-        with database.Gw2Database() as conn: # Connection here
-            unit_cost = conn.vendor_price(item_id)
+        unit_cost = vendor_prices.price(item_id)
         if unit_cost is None:
             unit_cost = gw2api.v2_listings_buy(item_id)
             if unit_cost == 0:
@@ -44,7 +74,8 @@ def crafting_cost(item_identifier, *, debug = False):
     pool.join()
     pool.stop_threads()
 
-    final_cost = sum([item_dict['total_cost'] for item_dict in pool.results])
+    # Costs are summed exactly and rounded once to the nearest copper, halves rounding up
+    final_cost = math.floor(sum([item_dict['total_cost'] for item_dict in pool.results]) + Fraction(1, 2))
     
     
     if debug:
@@ -53,28 +84,47 @@ def crafting_cost(item_identifier, *, debug = False):
             print(ingredient_dict)
         print(final_cost)
         import webbrowser
-        webbrowser.open('https://wiki.guildwars2.com/wiki/'+ item_identifier)
+        if isinstance(item_identifier, str):
+            webbrowser.open('https://wiki.guildwars2.com/wiki/'+ item_identifier)
+        else:
+            # An item id has no wiki page of its own, search the wiki for it instead
+            webbrowser.open('https://wiki.guildwars2.com/index.php?search='+ str(item_identifier))
 
     # Otherwise just return sum of costs
     return final_cost
 
-def watchlist_compute(input_file, output_file, *, debug = False):
+def watchlist_compute(input_file, output_file, *, debug = False, catalog = None):
     if debug:
         import time
         start = time.time()
     
     '''Reads item names from input_file and writes crafting cost, tp sell price, 
     and ROI info for each item to output_file.
-    Arguments: input_file, output_file'''
+    Arguments: input_file, output_file, catalog (see crafting_cost)'''
+    import gw2api
 
-    # Lookup each item name in file, convert to ID, then add to items_to_compute
-    with database.Gw2Database() as conn:
+    def lookup(conn):
+        # Lookup each item name in file, convert to ID, then add to items_to_compute
         with open(input_file) as fin:
             items_to_compute = []
             for line in fin:
                 item_name = line.rstrip('\n')
                 item_id = conn.name_to_id(item_name)
                 items_to_compute.append({'item_id': item_id , 'item_name': item_name})
+        return items_to_compute
+
+    # Every item's base ingredients are resolved up front, one closure lookup for the whole list
+    if catalog is None:
+        import database
+        with database.Gw2Database() as conn:
+            items_to_compute = lookup(conn)
+            bases = _flatten(conn, [item_dict['item_id'] for item_dict in items_to_compute])
+            vendor_prices = conn.vendor_prices()
+    else:
+        items_to_compute = lookup(catalog)
+        bases = {item_dict['item_id']: catalog.base_ingredients(item_dict['item_id']) 
+                 for item_dict in items_to_compute}
+        vendor_prices = catalog.vendor_prices()
     
     # Create a blank file, write current time, and column headers
     import datetime
@@ -91,7 +141,7 @@ def watchlist_compute(input_file, output_file, *, debug = False):
         
         _id = item_dict['item_id']
         
-        item_dict['craft_cost'] = crafting_cost(_id)
+        item_dict['craft_cost'] = _crafting_cost(_id, bases[_id], vendor_prices)
         item_dict['sell_listing'] = gw2api.v2_listings_sell(_id)
 
         # item_dict - {'item_id': <>, 'item_id': <>, 'crafting_cost': <>, 'sell_listing': <>}
@@ -121,11 +171,99 @@ def watchlist_compute(input_file, output_file, *, debug = False):
                   item_dict['sell_listing']))
             fout.write('{:>35} {:>20} {:>15} {:>15}\n'.format(*line))
         
+def scenario_matrix(shocks = (0,)):
+    '''Every combination of input side, exit side and shock (percent, applied to both 
+    ingredient and output prices), e.g. scenario_matrix((-10, 0, 10)) gives 12 scenarios.
+    Build Scenario tuples directly for independent input and exit shocks.'''
+    scenarios = []
+    for inputs, exit, shock in itertools.product(('buy', 'sell'), ('sell', 'buy'), shocks):
+        name = '{}/{} {:+}%'.format(inputs, exit, shock)
+        scenarios.append(Scenario(name, inputs, exit, shock, shock))
+    return scenarios
+
+def scenario_table(item_identifiers, scenarios, *, catalog = None, sort_by = 'roi'):
+    '''Craft cost, net of fee revenue and ROI of every item under every scenario.
+    Recipes are flattened once, all prices are fetched in one bulk request, and each 
+    scenario is then a rescaling of precomputed craft costs per item, so no 
+    crafting_cost call is made.  Shocks only move trading post prices, vendor 
+    priced ingredients always cost the same.
+    Arguments: item_identifiers - item names or ids
+               scenarios - list of Scenario, see scenario_matrix
+               catalog - optional catalog.Catalog snapshot (see crafting_cost)
+               sort_by - ScenarioRow field to sort on, descending
+    Return value: [ScenarioRow, ...]'''
+    import gw2api
+
+    # Flatten recipes and look up vendor prices of every ingredient
+    if catalog is None:
+        import database
+        with database.Gw2Database() as conn:
+            ids = [conn.name_to_id(x) if isinstance(x, str) else x for x in item_identifiers]
+            names = {item_id: name for item_id, name in zip(ids, item_identifiers) if isinstance(name, str)}
+            ids = [item_id for item_id in ids if item_id is not None] # Unknown names are skipped
+            names = conn.item_names([item_id for item_id in ids if item_id not in names]) | names
+            bases = _flatten(conn, ids)
+            ingredient_ids = {ing['item_id'] for base in bases.values() for ing in base}
+            vendor_prices = conn.vendor_prices()
+    else:
+        ids = [catalog.name_to_id(x) if isinstance(x, str) else x for x in item_identifiers]
+        ids = [item_id for item_id in ids if item_id is not None]
+        names = {item_id: catalog.item_name(item_id) for item_id in ids}
+        bases = {item_id: catalog.base_ingredients(item_id) for item_id in ids}
+        ingredient_ids = {ing['item_id'] for base in bases.values() for ing in base}
+        vendor_prices = catalog.vendor_prices()
+
+    prices = gw2api.v2_prices(*(ingredient_ids | set(ids)))
+
+    # Unit cost of each trading post ingredient per input side, the chosen side of the 
+    # trading post falling back to the other side when it is empty.  Vendor prices come 
+    # first as in crafting_cost and are kept apart since shocks do not apply to them
+    unit_cost = {'buy': {}, 'sell': {}}
+    for x in ingredient_ids:
+        if vendor_prices.price(x) is None:
+            buy, sell = prices.get(x, (0, 0))
+            unit_cost['buy'][x] = buy or sell
+            unit_cost['sell'][x] = sell or buy
+
+    # Unshocked craft cost of each item: the vendor part, and the trading post part per input side
+    vendor_cost = {item_id: sum(ing['count'] * vendor_prices.price(ing['item_id']) 
+                                for ing in bases[item_id] if vendor_prices.price(ing['item_id']) is not None)
+                   for item_id in ids}
+    tp_cost = {side: {item_id: sum(ing['count'] * costs[ing['item_id']] 
+                                   for ing in bases[item_id] if ing['item_id'] in costs)
+                      for item_id in ids}
+               for side, costs in unit_cost.items()}
+
+    table = []
+    for item_id in ids:
+        buy, sell = prices.get(item_id, (0, 0))
+        exit_price = {'buy': buy, 'sell': sell}
+        name = names.get(item_id) or str(item_id) # Always a string so any column sorts
+
+        for scenario in scenarios:
+            craft_cost = vendor_cost[item_id] + tp_cost[scenario.inputs][item_id] * (1 + scenario.input_shock / 100)
+            revenue = exit_price[scenario.exit] * (1 + scenario.exit_shock / 100) * TP_FEE_FACTOR
+            roi = (revenue - craft_cost) / craft_cost * 100 if craft_cost else 0
+            table.append(ScenarioRow(item_id, name, scenario.name, int(craft_cost), int(revenue), roi))
+
+    table.sort(key = lambda row: getattr(row, sort_by), reverse = True)
+    return table
+
+def _flatten(conn, item_ids):
+    '''Base ingredients of every id in item_ids from one base_ingredients_many query, items 
+    without closure rows (base items, or the table is not built) fall back to base_ingredients.
+    Return value: {item_id: [{item_id: <> ,item_name: <> , count: <> }, ...], ...}'''
+    bases = conn.base_ingredients_many(item_ids)
+    for item_id in item_ids:
+        if item_id not in bases:
+            bases[item_id] = conn.base_ingredients(item_id)
+    return bases
+
 def _roi(craft, sell):
     '''Return on investment, returns an integer'''
     try:
         # Potentially DivisionByZero Exception
-        roi = int((sell*0.85-craft)/craft*100)
+        roi = int((sell*TP_FEE_FACTOR-craft)/craft*100)
     except:
         roi = 0
     return str(roi)
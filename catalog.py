@@ -0,0 +1,434 @@
+''' Contains the binary catalog format: the api dump files (one JSON object per line) are parsed
+once, in parallel, into compact columnar files that can be memory mapped instead of re-parsed.
+
+Each table is a single file laid out as:
+	header - magic, version, number of columns, number of rows
+	column descriptors - name, kind ('i' for int32, 's' for utf-8 string), data offset, data length
+	column data - int32 arrays, or for strings an (nrows + 1) uint32 offsets array followed by the text
+
+Arrays are written in native byte order, so a catalog is meant to be read on the machine that built it.'''
+
+import os
+import json
+import mmap
+import struct
+from fractions import Fraction
+from array import array
+from multiprocessing import Pool, cpu_count
+from vendorprices import VendorPrices
+
+_MAGIC = b'GW2C'
+_VERSION = 1
+_HEADER = struct.Struct('=4sHHI')			# magic, version, ncols, nrows
+_DESCRIPTOR = struct.Struct('=16s1s7xQQ')	# name, kind, offset, length
+_ALIGN = 8
+
+# Table name -> [(column name, kind), ...]
+SCHEMA = {
+	'items': [('item_id', 'i'), ('name', 's'), ('type', 's'), ('rarity', 's')],
+	'recipes': [('recipe_id', 'i'), ('item_id', 'i'), ('output_count', 'i')],
+	'ingredients': [('recipe_id', 'i'), ('item_id', 'i'), ('item_count', 'i')],
+	'disciplines': [('recipe_id', 'i'), ('discipline', 's')],
+	'vendor_items': [('item_id', 'i'), ('price', 'i'), ('count', 'i')],
+}
+
+# Dump kind -> tables produced from a single pass over that dump
+_DUMP_TABLES = {
+	'items': ['items'],
+	'recipes': ['recipes', 'ingredients', 'disciplines'],
+}
+
+def _shard_offsets(file_path, num_shards):
+	'''Splits file_path into at most num_shards byte ranges [(start, stop), ...] whose
+	boundaries fall just after a newline, so every line belongs to exactly one shard'''
+
+	size = os.path.getsize(file_path)
+	step = max(size // num_shards, 1)
+	bounds = [0]
+
+	with open(file_path, 'rb') as f:
+		position = step
+		while position < size:
+			f.seek(position)
+			f.readline() # Move to the start of the next full line
+			boundary = f.tell()
+			if boundary >= size:
+				break
+			if boundary > bounds[-1]:
+				bounds.append(boundary)
+			position = boundary + step
+	bounds.append(size)
+
+	return list(zip(bounds[:-1], bounds[1:]))
+
+def _empty_columns(table_names):
+	'''Returns {table: {column: array or list}} ready to be appended to'''
+	result = {}
+	for table in table_names:
+		result[table] = {name: array('i') if kind == 'i' else [] for name, kind in SCHEMA[table]}
+	return result
+
+def _parse_shard(task):
+	'''Worker for the process pool.  Parses the lines of one byte range and returns the
+	column data for every table that the dump kind produces'''
+
+	file_path, start, stop, kind = task
+	tables = _empty_columns(_DUMP_TABLES[kind])
+
+	with open(file_path, 'rb') as f:
+		f.seek(start)
+		data = f.read(stop - start)
+
+	for line in data.splitlines():
+		if not line.strip():
+			continue
+		obj = json.loads(line)
+
+		if kind == 'items':
+			items = tables['items']
+			items['item_id'].append(obj['id'])
+			items['name'].append(obj['name'])
+			items['type'].append(obj['type'])
+			items['rarity'].append(obj['rarity'])
+		else:
+			recipes = tables['recipes']
+			recipes['recipe_id'].append(obj['id'])
+			recipes['item_id'].append(obj['output_item_id'])
+			recipes['output_count'].append(obj['output_item_count'])
+
+			ingredients = tables['ingredients']
+			for ing in obj['ingredients']: # Each value is a dictionary of form {item_id: count}
+				ingredients['recipe_id'].append(obj['id'])
+				ingredients['item_id'].append(ing['item_id'])
+				ingredients['item_count'].append(ing['count'])
+
+			disciplines = tables['disciplines']
+			for disc in obj['disciplines']:
+				disciplines['recipe_id'].append(obj['id'])
+				disciplines['discipline'].append(disc)
+
+	return tables
+
+def parse_dump(file_path, kind, *, processes = None):
+	'''Parses a whole dump file of kind 'items' or 'recipes' across a pool of processes.
+	Return value: {table: {column: array or list}}, rows kept in file order'''
+
+	processes = processes or cpu_count()
+	tasks = [(file_path, start, stop, kind) for start, stop in _shard_offsets(file_path, processes)]
+	tables = _empty_columns(_DUMP_TABLES[kind])
+
+	if len(tasks) > 1:
+		with Pool(min(processes, len(tasks))) as pool:
+			shards = pool.map(_parse_shard, tasks) # map preserves shard order
+	else:
+		shards = [_parse_shard(task) for task in tasks]
+
+	for shard in shards:
+		for table, columns in shard.items():
+			for name, values in columns.items():
+				tables[table][name].extend(values)
+	return tables
+
+def _pad(f):
+	f.write(b'\0' * (-f.tell() % _ALIGN))
+
+def write_table(file_path, table, columns):
+	'''Writes the columns {column: array or list} of one table to file_path in catalog format'''
+
+	schema = SCHEMA[table]
+	nrows = len(columns[schema[0][0]])
+
+	with open(file_path, 'wb') as f:
+		f.write(_HEADER.pack(_MAGIC, _VERSION, len(schema), nrows))
+		descriptors_at = f.tell()
+		f.write(b'\0' * (_DESCRIPTOR.size * len(schema)))
+
+		descriptors = []
+		for name, kind in schema:
+			values = columns[name]
+			if len(values) != nrows:
+				raise ValueError('column {} of {} has {} rows, expected {}'.format(name, table, len(values), nrows))
+			_pad(f)
+			offset = f.tell()
+
+			if kind == 'i':
+				array('i', values).tofile(f)
+			else:
+				encoded = [value.encode('utf-8') for value in values]
+				offsets = array('I', [0])
+				for text in encoded:
+					offsets.append(offsets[-1] + len(text))
+				offsets.tofile(f)
+				f.write(b''.join(encoded))
+
+			descriptors.append(_DESCRIPTOR.pack(name.encode('ascii'), kind.encode('ascii'), offset, f.tell() - offset))
+
+		f.seek(descriptors_at)
+		f.write(b''.join(descriptors))
+
+def build(item_dump, recipe_dump, catalog_dir, *, processes = None):
+	'''Parses both dump files and writes items.bin, recipes.bin, ingredients.bin and
+	disciplines.bin to catalog_dir.  Each dump is read exactly once.'''
+
+	os.makedirs(catalog_dir, exist_ok = True)
+	for file_path, kind in ((item_dump, 'items'), (recipe_dump, 'recipes')):
+		for table, columns in parse_dump(file_path, kind, processes = processes).items():
+			# Write to a temporary file first so readers never map a half written table
+			target = os.path.join(catalog_dir, table + '.bin')
+			write_table(target + '.tmp', table, columns)
+			os.replace(target + '.tmp', target)
+
+def write_vendor(catalog_dir, rows):
+	'''Writes vendor_items.bin from rows of (item_id, price, count), for example
+	dataparse.vendor_gen(), so the catalog can serve as a complete snapshot'''
+
+	columns = _empty_columns(['vendor_items'])['vendor_items']
+	for item_id, price, count in rows:
+		columns['item_id'].append(item_id)
+		columns['price'].append(price)
+		columns['count'].append(count)
+
+	os.makedirs(catalog_dir, exist_ok = True)
+	target = os.path.join(catalog_dir, 'vendor_items.bin')
+	write_table(target + '.tmp', 'vendor_items', columns)
+	os.replace(target + '.tmp', target)
+
+def exists(catalog_dir, *, vendor = True):
+	'''True if catalog_dir holds a built catalog.  Unless vendor is False the vendor_items 
+	table (catalog.write_vendor) is required too, without it every vendor item would be 
+	priced from the trading post'''
+	tables = ['items', 'recipes', 'ingredients'] + (['vendor_items'] if vendor else [])
+	return all(os.path.exists(os.path.join(catalog_dir, table + '.bin')) for table in tables)
+
+class _StringColumn:
+	'''Read only sequence of strings backed by an offsets array and a utf-8 blob'''
+	def __init__(self, offsets, blob):
+		self.offsets = offsets
+		self.blob = blob
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += len(self)
+		if not 0 <= index < len(self):
+			raise IndexError('string column index out of range')
+		return str(self.blob[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+
+	def __iter__(self):
+		for i in range(len(self)):
+			yield self[i]
+
+class CatalogTable:
+	'''Memory mapped view of one catalog file.  Columns are accessed by name and
+	are only decoded when read.'''
+	def __init__(self, file_path):
+		self.path = file_path
+		with open(file_path, 'rb') as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		self._view = memoryview(self._mmap)
+		self.columns = {}
+
+		magic, version, ncols, self.nrows = _HEADER.unpack_from(self._mmap, 0)
+		if magic != _MAGIC or version != _VERSION:
+			self.close()
+			raise ValueError('{} is not a version {} catalog file'.format(file_path, _VERSION))
+
+		for i in range(ncols):
+			name, kind, offset, length = _DESCRIPTOR.unpack_from(self._mmap, _HEADER.size + i * _DESCRIPTOR.size)
+			name = name.rstrip(b'\0').decode('ascii')
+			data = self._view[offset:offset + length]
+
+			if kind == b'i':
+				self.columns[name] = data.cast('i')
+			else:
+				split = (self.nrows + 1) * 4
+				self.columns[name] = _StringColumn(data[:split].cast('I'), data[split:])
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __len__(self):
+		return self.nrows
+
+	def __getitem__(self, column_name):
+		return self.columns[column_name]
+
+	def rows(self, *column_names):
+		'''Generator of lists holding the values of column_names for each row'''
+		columns = [self.columns[name] for name in column_names]
+		for i in range(self.nrows):
+			yield [column[i] for column in columns]
+
+	def close(self):
+		# Views into the map must be released before the map itself can be closed
+		for column in self.columns.values():
+			if isinstance(column, _StringColumn):
+				column.offsets.release()
+				column.blob.release()
+			else:
+				column.release()
+		self.columns = {}
+		self._view.release()
+		self._mmap.close()
+
+class Catalog:
+	'''Recipe engine over a built catalog directory.  Mirrors the lookups of
+	database.Gw2Database (name_to_id, _ingredients, base_ingredients, vendor_price) without
+	a database connection.'''
+	def __init__(self, catalog_dir):
+		self.tables = {}
+		for table in SCHEMA:
+			file_path = os.path.join(catalog_dir, table + '.bin')
+			if os.path.exists(file_path):
+				self.tables[table] = CatalogTable(file_path)
+
+		self._names = None
+		self._item_names = None
+		self._recipes = None
+		self._ingredient_ranges = None
+		self._vendor = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def close(self):
+		for table in self.tables.values():
+			table.close()
+		self.tables = {}
+
+	# Indexes are built on first use into locals and only then published, so threads
+	# sharing a Catalog (e.g. ThreadPool workers) never see a half built index
+
+	def _index_items(self):
+		# Lowercased name -> item_id, and item_id -> row
+		items = self.tables['items']
+		names = {}
+		item_names = {}
+		for i, (item_id, name) in enumerate(zip(items['item_id'], items['name'])):
+			names.setdefault(name.lower(), item_id)
+			item_names[item_id] = i
+		self._item_names = item_names
+		self._names = names
+
+	def _index_recipes(self):
+		# output item_id -> (recipe_id, output_count), the lowest recipe_id wins like in the closure table
+		recipes = self.tables['recipes']
+		output = {}
+		for recipe_id, item_id, output_count in zip(recipes['recipe_id'], recipes['item_id'], recipes['output_count']):
+			if item_id not in output or recipe_id < output[item_id][0]:
+				output[item_id] = (recipe_id, output_count)
+
+		# recipe_id -> (start, stop) rows in the ingredients table, rows of a recipe are contiguous
+		ranges = {}
+		recipe_ids = self.tables['ingredients']['recipe_id']
+		start = 0
+		for i in range(1, len(recipe_ids) + 1):
+			if i == len(recipe_ids) or recipe_ids[i] != recipe_ids[start]:
+				ranges[recipe_ids[start]] = (start, i)
+				start = i
+		self._ingredient_ranges = ranges
+		self._recipes = output
+
+	def vendor_prices(self):
+		'''VendorPrices for the snapshot's vendor_items table (empty if it has none)'''
+		if self._vendor is None:
+			rows = []
+			if 'vendor_items' in self.tables:
+				rows = list(self.tables['vendor_items'].rows('item_id', 'price', 'count'))
+			self._vendor = VendorPrices(rows)
+		return self._vendor
+
+	def name_to_id(self, item_name):
+		''' Converts item_name argument to its corresponding item ID listed in the catalog'''
+		if self._names is None:
+			self._index_items()
+		return self._names.get(item_name.lower())
+
+	def item_name(self, item_id):
+		if self._item_names is None:
+			self._index_items()
+		row = self._item_names.get(item_id)
+		return None if row is None else self.tables['items']['name'][row]
+
+	def output_count(self, item_id):
+		if self._recipes is None:
+			self._index_recipes()
+		recipe = self._recipes.get(item_id)
+		return None if recipe is None else recipe[1]
+
+	def vendor_price(self, item_id):
+		''' Same return value as Gw2Database.vendor_price: the price, or None when the item
+		is not sold by vendors (or the catalog has no vendor_items table)'''
+		return self.vendor_prices().price(item_id)
+
+	def _ingredients(self, item_identifier):
+		''' Same return value as Gw2Database._ingredients:
+		[{item_id: <> ,item_name: <> , count: <> }, ...] or None'''
+
+		if isinstance(item_identifier, str):
+			item_id = self.name_to_id(item_identifier)
+		else:
+			item_id = item_identifier
+		if self._recipes is None:
+			self._index_recipes()
+
+		recipe = self._recipes.get(item_id)
+		if recipe is None or recipe[0] not in self._ingredient_ranges:
+			return None
+
+		start, stop = self._ingredient_ranges[recipe[0]]
+		ingredients = self.tables['ingredients']
+		return [{'item_id': ingredients['item_id'][i],
+				 'item_name': self.item_name(ingredients['item_id'][i]),
+				 'count': ingredients['item_count'][i]} for i in range(start, stop)]
+
+	def base_ingredients(self, item_identifier):
+		''' Same return value as Gw2Database.base_ingredients:
+		[{item_id: <> ,item_name: <> , count: <> }, ...]
+		Counts are exact (int or Fraction), like the closure table.'''
+
+		if isinstance(item_identifier, str):
+			item_id = self.name_to_id(item_identifier)
+		else:
+			item_id = item_identifier
+
+		result = self._ingredients(item_id)
+		if result is None:
+			return [{'item_id': item_id, 'count': 1}]
+
+		base = {} # item_id -> ingredient dictionary, merges duplicates
+		while result:
+			temp = []
+			for upper in result:
+				lower_list = self._ingredients(upper['item_id'])
+				if lower_list is None:
+					if upper['item_id'] in base:
+						base[upper['item_id']]['count'] += upper['count']
+					else:
+						base[upper['item_id']] = upper
+				else:
+					output_quantity = self.output_count(upper['item_id'])
+					for lower in lower_list:
+						lower['count'] = Fraction(lower['count']*upper['count'], output_quantity)
+					temp += lower_list
+			result = temp
+		return list(base.values())
+
+if __name__ == '__main__':
+	import paths
+
+	def unit_test1():
+		build(paths.logs + 'item_dump.txt', paths.logs + 'recipe_dump.txt', paths.catalog)
+		with Catalog(paths.catalog) as catalog:
+			for x in catalog.base_ingredients("berserker's draconic coat"):
+				print(x)
+
+	unit_test1()
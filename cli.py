@@ -0,0 +1,71 @@
+''' Command line entry point for crafting_cost and watchlist_compute.
+
+	python cli.py cost "Oiled Forged Scrap"
+	python cli.py watchlist watchlists/runes.csv watchlists/runes_output.txt
+
+When a catalog snapshot exists (see catalog.build and catalog.write_vendor) items, recipes and
+vendor prices are memory mapped from it and no database connection is made.  Only the standard
+library is imported up front; everything else is imported once the command is known.'''
+
+import sys
+import time
+import argparse
+
+import paths
+
+def _open_catalog(catalog_dir):
+	'''Returns a catalog.Catalog for catalog_dir, or None to fall back to the database'''
+	import catalog
+	if catalog_dir and catalog.exists(catalog_dir):
+		return catalog.Catalog(catalog_dir)
+	if catalog_dir and catalog.exists(catalog_dir, vendor = False):
+		print('Catalog in {} has no vendor_items table (see catalog.write_vendor), '
+			  'using the database'.format(catalog_dir), file = sys.stderr)
+	return None
+
+def cost(args, snapshot):
+	import calculations
+	item = int(args.item) if args.item.isdigit() else args.item
+	value = calculations.crafting_cost(item, debug = args.debug, catalog = snapshot)
+	print('{}: {}'.format(args.item, calculations._gold(value)))
+
+def watchlist(args, snapshot):
+	import calculations
+	calculations.watchlist_compute(args.input_file, args.output_file, debug = args.debug, catalog = snapshot)
+	print('Written to {}'.format(args.output_file))
+
+def main(argv = None):
+	parser = argparse.ArgumentParser(description = 'Guild Wars 2 trading post crafting calculations')
+	parser.add_argument('--catalog', default = paths.catalog,
+						help = 'catalog snapshot directory (default: %(default)s)')
+	parser.add_argument('--no-catalog', action = 'store_true',
+						help = 'always use the database')
+	parser.add_argument('--debug', action = 'store_true')
+	parser.add_argument('--time', action = 'store_true', help = 'print the runtime')
+	commands = parser.add_subparsers(dest = 'command')
+	commands.required = True
+
+	cost_parser = commands.add_parser('cost', help = 'crafting cost of one item (name or id)')
+	cost_parser.add_argument('item')
+	cost_parser.set_defaults(func = cost)
+
+	watchlist_parser = commands.add_parser('watchlist', help = 'crafting cost and ROI of every item in a file')
+	watchlist_parser.add_argument('input_file')
+	watchlist_parser.add_argument('output_file')
+	watchlist_parser.set_defaults(func = watchlist)
+
+	args = parser.parse_args(argv)
+	start = time.time()
+
+	snapshot = None if args.no_catalog else _open_catalog(args.catalog)
+	try:
+		args.func(args, snapshot)
+	finally:
+		if snapshot is not None:
+			snapshot.close()
+
+	if args.time:
+		print('{:.3f}s'.format(time.time() - start))
+
+if __name__ == '__main__':
+	main()
@@ -1,6 +1,45 @@
 import sys
+import json
+import time
+import threading
+import itertools
+from fractions import Fraction
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from vendorprices import VendorPrices
+
+# vendor_items is small and static, so it is read once per process and shared by every 
+# connection.  At most every VENDOR_CHECK_INTERVAL seconds a checksum of the table is 
+# compared, so a reload by dataparse in another process is picked up without rereading 
+# the table on every lookup.  invalidate_vendor_prices() forces a reload in this process.
+VENDOR_CHECK_INTERVAL = 60
+_vendor_prices = None
+_vendor_checksum = None
+_vendor_checked = 0
+_vendor_lock = threading.Lock()
+
+# Unique names for server side cursors
+_cursor_ids = itertools.count()
+
+class _CountingWriter:
+	'''Binary file wrapper that counts the bytes written through it.  It is not an io.TextIOBase, 
+	so copy_expert hands it bytes; str (the NDJSON path) is encoded as utf-8.'''
+	def __init__(self, f):
+		self.f = f
+		self.bytes = 0
+
+	def write(self, data):
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+		self.bytes += len(data)
+		return self.f.write(data)
+
+def invalidate_vendor_prices():
+	global _vendor_prices, _vendor_checksum
+	with _vendor_lock:
+		_vendor_prices = None
+		_vendor_checksum = None
 
 class DatabaseConnection:
 	def __init__(self, dbname, autocommit = False):
@@ -35,7 +74,8 @@ class DatabaseConnection:
 	def get_columns(self, table_name):
 		query = '''select column_name 
 				from information_schema.columns 
-				where table_name = %s;'''
+				where table_name = %s
+				order by ordinal_position;'''
 
 		self.cursor.execute(query, [table_name])  
 		return [res[0] for res in self.cursor.fetchall()]
@@ -57,12 +97,14 @@ class DatabaseConnection:
 		# Create a string of comma separated placeholders
 		values = ', '.join(['%s'] * len(kwargs['values']))						
 		
-		if not kwargs['columns']:
+		if kwargs.get('columns'):
+			columns = ', '.join(kwargs['columns'])
+		else:
 			# Fetch the column names for the provided table concatenate with commas
 			columns = ', '.join(self.get_columns(table_name))			
 		
 		query = "INSERT INTO {{}} ({}) VALUES ({})".format(columns, values)
-		self.cursor.execute(sql.SQL(query).format(sql.Identifier(table_name)), args)
+		self.cursor.execute(sql.SQL(query).format(sql.Identifier(table_name)), kwargs['values'])
 
 	def select_all(self, table_name):
 		query = "SELECT * from {}"
@@ -72,9 +114,100 @@ class DatabaseConnection:
 	def commit(self):
 		self.connection.commit()
 
+	def iter_query(self, query, params = None, *, chunk_size = 10000):
+		'''Generator of lists of at most chunk_size rows for query, read through a named 
+		(server side) cursor so only one chunk is held in client memory at a time.
+		query may be a string or a psycopg2.sql object.'''
+		for columns, rows in self._stream(query, params, chunk_size):
+			yield rows
+
+	def _stream(self, query, params, chunk_size):
+		'''Generator of (column names, rows) chunks behind iter_query'''
+		
+		# A named cursor only streams inside a transaction (WITH HOLD would have the server 
+		# store the whole result before the first fetch).  When no transaction is open, 
+		# autocommit is turned off for the duration and the stream ends the one it started.
+		autocommit = self.connection.autocommit
+		started = autocommit or self.connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+		if autocommit:
+			self.connection.autocommit = False
+		cursor = self.connection.cursor(name = 'stream_{}'.format(next(_cursor_ids)))
+		cursor.itersize = chunk_size
+		done = False
+		try:
+			cursor.execute(query, params)
+			while True:
+				rows = cursor.fetchmany(chunk_size)
+				if not rows:
+					break
+				# description of a named cursor is only filled in after the first fetch
+				yield [column[0] for column in cursor.description], rows
+			done = True
+		finally:
+			try:
+				cursor.close()
+			finally:
+				if started:
+					if done:
+						self.connection.commit()
+					else:
+						self.connection.rollback()
+				if autocommit:
+					self.connection.autocommit = True
+
+	def iter_table(self, table_name, *, chunk_size = 10000):
+		'''Same as iter_query for every row of table_name'''
+		query = sql.SQL('SELECT * FROM {}').format(sql.Identifier(table_name))
+		return self.iter_query(query, chunk_size = chunk_size)
+
+	def export_table(self, table_name, file_path, *, fmt = 'csv', chunk_size = 10000, verbose = False):
+		'''Writes every row of table_name to file_path, see export_query'''
+		query = sql.SQL('SELECT * FROM {}').format(sql.Identifier(table_name))
+		return self.export_query(query, file_path, fmt = fmt, chunk_size = chunk_size, verbose = verbose)
+
+	def export_query(self, query, file_path, params = None, *, fmt = 'csv', chunk_size = 10000, verbose = False):
+		'''Writes the result of query to file_path in constant memory.
+		fmt - 'csv' streams COPY ... TO STDOUT (with a header row) straight into the file
+			  'ndjson' writes one JSON object per row, chunk by chunk from iter_query
+		Return value: {rows: <>, bytes: <>, seconds: <>, rows_per_second: <>}
+		For CSV, rows is the cursor's rowcount after COPY (set by psycopg2 since 2.5.3), 
+		or None if the server did not report it.'''
+		
+		# Checked before the file is opened, which would truncate it
+		if fmt not in ('csv', 'ndjson'):
+			raise ValueError("fmt must be 'csv' or 'ndjson', not {!r}".format(fmt))
+		if not isinstance(query, str):
+			query = query.as_string(self.connection)
+		if params is not None:
+			# COPY does not take parameters, so bind them client side
+			query = self.cursor.mogrify(query, params).decode()
+		
+		start = time.time()
+		rows = 0
+		with open(file_path, 'wb') as f:
+			out = _CountingWriter(f)
+			if fmt == 'csv':
+				self.cursor.copy_expert('COPY ({}) TO STDOUT WITH CSV HEADER'.format(query.rstrip().rstrip(';')), out)
+				rows = self.cursor.rowcount if self.cursor.rowcount >= 0 else None
+			else:
+				for columns, chunk in self._stream(query, None, chunk_size):
+					# default = str covers dates, decimals and the like
+					out.write(''.join([json.dumps(dict(zip(columns, row)), default = str) + '\n' for row in chunk]))
+					rows += len(chunk)
+		
+		seconds = time.time() - start
+		stats = {'rows': rows, 
+				 'bytes': out.bytes, 
+				 'seconds': seconds, 
+				 'rows_per_second': rows / seconds if rows and seconds else 0}
+		if verbose:
+			print('{rows} rows, {bytes} bytes in {seconds:.2f}s ({rows_per_second:.0f} rows/s)'.format(**stats))
+		return stats
+
 class Gw2Database(DatabaseConnection):
 	def __init__(self, autocommit = False):
 		DatabaseConnection.__init__(self, 'gw2', autocommit)
+		self._has_closure = None # Whether base_ingredient_closure exists, looked up on first use
 
 	def name_to_id(self, item_name):
 		''' Converts item_name argument to its corresponding item ID listed in 
@@ -89,9 +222,18 @@ class Gw2Database(DatabaseConnection):
 		except:
 			return None
 
+	def item_names(self, item_ids):
+		''' Returns {item_id: name} for every id in item_ids found in the items table'''
+		
+		query = "select item_id, name from items where item_id = ANY(%s)"
+		self.cursor.execute(query, (list(item_ids),))
+		return dict(self.cursor.fetchall())
+
 	def _ingredients(self, item_identifier):
 		''' Returns a list of dictionaries for item_identifier argument 
 		(name or ID) representing required crafting ingredients one level lower. 
+		Only the item's lowest recipe_id is used, like in base_ingredient_closure, and 
+		ingredients missing from the items table are kept with item_name None.
 		Return value: [{item_id: <> ,item_name: <> , count: <> }, ...]
 		If no lower level ingredients are found, returns None'''
 		
@@ -104,9 +246,9 @@ class Gw2Database(DatabaseConnection):
 		query = '''SELECT ingredients.item_id, items.name, ingredients.item_count
 				FROM recipes INNER JOIN ingredients 
 				ON recipes.recipe_id = ingredients.recipe_id
-				INNER JOIN items
+				LEFT JOIN items
 				ON items.item_id = ingredients.item_id
-				WHERE recipes.item_id = %s'''
+				WHERE recipes.recipe_id = (SELECT min(recipe_id) FROM recipes WHERE item_id = %s)'''
 		# If item_id = None, its value is parsed to NULL
 		self.cursor.execute(query, (item_id,))
 		
@@ -118,10 +260,124 @@ class Gw2Database(DatabaseConnection):
 		else:
 			return None
 	
-	def base_ingredients(self, item_identifier):		
+	def base_ingredients(self, item_identifier):
+		''' Returns list of dictionaries of item_identifier argument (name or ID) 
+		representing the absolute base crafting ingredients.  
+		Reads the precomputed base_ingredient_closure table (see build_closure), 
+		falling back to _base_ingredients_recursive when the item has no rows there.
+		Return value: [{item_id: <> ,item_name: <> , count: <> }, ...]'''
+		
+		if isinstance(item_identifier, str):
+			item_id = self.name_to_id(item_identifier)
+		else:
+			item_id = item_identifier
+
+		result = self.base_ingredients_many([item_id]).get(item_id)
+		if result is None:
+			# Base items have no closure rows, and the table may not be built yet
+			return self._base_ingredients_recursive(item_id)
+		return result
+
+	def base_ingredients_many(self, item_ids):
+		''' Looks up the base ingredients of every id in item_ids with one query on 
+		base_ingredient_closure.  Items without closure rows are left out.
+		Return value: {output_item_id: [{item_id: <> ,item_name: <> , count: <> }, ...], ...}'''
+		
+		query = '''SELECT closure.output_item_id, closure.base_item_id, items.name, closure.quantity
+				FROM base_ingredient_closure AS closure LEFT JOIN items
+				ON items.item_id = closure.base_item_id
+				WHERE closure.output_item_id = ANY(%s)
+				ORDER BY closure.output_item_id, closure.base_item_id'''
+		# Closure table may not exist yet, checked up front (once per connection) so an open 
+		# transaction survives.  build_closure sets the flag itself.
+		if self._has_closure is None:
+			self.cursor.execute("SELECT to_regclass('base_ingredient_closure')")
+			self._has_closure = self.cursor.fetchone()[0] is not None
+		if not self._has_closure:
+			return {}
+		self.cursor.execute(query, (list(item_ids),))
+
+		result = {}
+		for output_item_id, base_item_id, item_name, quantity in self.cursor.fetchall():
+			# numeric keeps 20 digits of 1/3 and the like, recover the exact fraction so 
+			# counts match the recursive walk and the catalog
+			result.setdefault(output_item_id, []).append({'item_id': base_item_id, 
+														  'item_name': item_name, 
+														  'count': Fraction(quantity).limit_denominator(10**6)})
+		return result
+
+	# Expands every recipe of the roots down to base items.  One recipe is used per output 
+	# item (the lowest recipe_id), an item is base when that recipe has no ingredient rows
+	# or it has no recipe at all, and depth is capped in case of cycles.
+	# Like _base_ingredients_recursive the quantities are for one craft of the root, so the 
+	# root's output count is not divided out; intermediate items are scaled per unit.
+	_closure_query = '''
+		WITH RECURSIVE primary_recipes AS (
+			SELECT DISTINCT ON (item_id) recipe_id, item_id, output_count
+			FROM recipes ORDER BY item_id, recipe_id
+		), expand(output_item_id, item_id, quantity, depth) AS (
+			SELECT r.item_id, i.item_id, i.item_count::numeric, 1
+			FROM primary_recipes AS r INNER JOIN ingredients AS i
+			ON r.recipe_id = i.recipe_id
+			WHERE {roots}
+		UNION ALL
+			SELECT e.output_item_id, i.item_id, e.quantity * i.item_count / r.output_count, e.depth + 1
+			FROM expand AS e INNER JOIN primary_recipes AS r
+			ON r.item_id = e.item_id
+			INNER JOIN ingredients AS i
+			ON r.recipe_id = i.recipe_id
+			WHERE e.depth < 32
+		)
+		INSERT INTO base_ingredient_closure (output_item_id, base_item_id, quantity)
+		SELECT e.output_item_id, e.item_id, sum(e.quantity)
+		FROM expand AS e
+		WHERE NOT EXISTS (SELECT 1 FROM primary_recipes AS r INNER JOIN ingredients AS i
+						  ON r.recipe_id = i.recipe_id WHERE r.item_id = e.item_id)
+		GROUP BY e.output_item_id, e.item_id'''
+
+	def build_closure(self):
+		''' (Re)builds the base_ingredient_closure table (output_item_id, base_item_id, quantity) 
+		for every recipe in the database.  Should be run after each catalog load.'''
+		
+		self.cursor.execute('''CREATE TABLE IF NOT EXISTS base_ingredient_closure (
+				output_item_id integer NOT NULL,
+				base_item_id integer NOT NULL,
+				quantity numeric NOT NULL,
+				PRIMARY KEY (output_item_id, base_item_id))''')
+		self.cursor.execute('TRUNCATE base_ingredient_closure')
+		self.cursor.execute(self._closure_query.format(roots = 'TRUE'))
+		self.cursor.execute('ANALYZE base_ingredient_closure')
+		self.commit()
+		self._has_closure = True
+
+	def refresh_closure(self, item_ids):
+		''' Incrementally refreshes base_ingredient_closure after the recipes producing 
+		item_ids were added, changed or removed.  Only those items and the items crafted 
+		from them (directly or indirectly) are recomputed.  dataparse reloads whole tables 
+		and so runs build_closure instead; this is for callers that change single recipes.'''
+		
+		query = '''WITH RECURSIVE affected(item_id) AS (
+					SELECT unnest(%s::integer[])
+				UNION
+					SELECT recipes.item_id
+					FROM affected INNER JOIN ingredients
+					ON ingredients.item_id = affected.item_id
+					INNER JOIN recipes
+					ON recipes.recipe_id = ingredients.recipe_id
+				)
+				SELECT item_id FROM affected'''
+		self.cursor.execute(query, (list(item_ids),))
+		affected = [row[0] for row in self.cursor.fetchall()]
+		
+		self.cursor.execute('DELETE FROM base_ingredient_closure WHERE output_item_id = ANY(%s)', (affected,))
+		self.cursor.execute(self._closure_query.format(roots = 'r.item_id = ANY(%s)'), (affected,))
+		self.commit()
+
+	def _base_ingredients_recursive(self, item_identifier):
 		''' Returns list of dictionaries of item_identifier argument (name or ID) 
 		representing the absolute base crafting ingredients.  
-		Works by repeatedly calling ingredients().
+		Works by repeatedly calling ingredients().  Counts are exact (int or Fraction), 
+		like the closure table.
 		Return value: [{item_id: <> ,item_name: <> , count: <> }, ...]'''
 		
 		if isinstance(item_identifier, str):
@@ -147,7 +403,7 @@ class Gw2Database(DatabaseConnection):
 				
 				else: 
 					# Get the output quantity of recipe
-					query = 'select output_count from recipes where item_id = %s'
+					query = 'select output_count from recipes where item_id = %s order by recipe_id limit 1'
 					self.cursor.execute(query, (upper['item_id'],))
 					output_quantity = self.cursor.fetchone()[0]
 					
@@ -156,7 +412,7 @@ class Gw2Database(DatabaseConnection):
 					
 					#Adjusts the count of lower level ingredients
 					for lower in lower_list:
-						lower['count'] = int(lower['count']*upper['count']/output_quantity)
+						lower['count'] = Fraction(lower['count']*upper['count'], output_quantity)
 					
 					# Append the lower level ingredients to results list 
 					temp += lower_list
@@ -194,17 +450,32 @@ class Gw2Database(DatabaseConnection):
 		
 		return _condense(result)
 
-	def vendor_price(self, item_id): 
-		''' Fetches vendor price of item_id arg from the vendor table in database.'''
+	def vendor_prices(self):
+		''' Returns the VendorPrices map (item_id -> (price, count)) of the vendor table, 
+		loaded with a single query the first time any connection asks for it and again 
+		only when the table's checksum changes (see VENDOR_CHECK_INTERVAL).'''
 		
-		query = 'SELECT * FROM vendor_items where item_id = %s'
-		self.cursor.execute(query, (item_id,))
-		try:
-			result = self.cursor.fetchone() # (item_id, price, count)
-			return result[1]
-		except TypeError:
-			# result set is empty (i.e. item is not in vendor table)
-			return None
+		global _vendor_prices, _vendor_checksum, _vendor_checked
+		with _vendor_lock:
+			now = time.time()
+			if _vendor_prices is not None and now - _vendor_checked < VENDOR_CHECK_INTERVAL:
+				return _vendor_prices
+			
+			query = '''SELECT md5(string_agg(vendor_items::text, ',' ORDER BY vendor_items::text))
+					FROM vendor_items'''
+			self.cursor.execute(query)
+			checksum = self.cursor.fetchone()[0]
+			if _vendor_prices is None or checksum != _vendor_checksum:
+				self.cursor.execute('SELECT * FROM vendor_items') # (item_id, price, count)
+				_vendor_prices = VendorPrices(self.cursor.fetchall())
+				_vendor_checksum = checksum
+			_vendor_checked = now
+			return _vendor_prices
+
+	def vendor_price(self, item_id): 
+		''' Fetches vendor price of item_id arg from the preloaded vendor table, 
+		None if the item is not in the vendor table.'''
+		return self.vendor_prices().price(item_id)
 
 if __name__ == '__main__':
 	def unit_test1():
@@ -219,5 +490,40 @@ if __name__ == '__main__':
 			for x in conn.base_ingredients("berserker's draconic coat"):
 				print(x)
 
+	def unit_test2():
+		''' The closure table and the recursive walk must agree, including for items whose 
+		recipe outputs more than one, items crafted from an item whose recipe has no 
+		ingredients, and items with an ingredient missing from the items table '''
+		with Gw2Database() as conn:
+			conn.cursor.execute('''(SELECT item_id FROM recipes WHERE output_count > 1 LIMIT 50)
+				UNION (SELECT r.item_id FROM recipes AS r INNER JOIN ingredients AS i
+					   ON r.recipe_id = i.recipe_id INNER JOIN recipes AS empty
+					   ON empty.item_id = i.item_id
+					   WHERE NOT EXISTS (SELECT 1 FROM ingredients WHERE recipe_id = empty.recipe_id) LIMIT 50)
+				UNION (SELECT r.item_id FROM recipes AS r INNER JOIN ingredients AS i
+					   ON r.recipe_id = i.recipe_id
+					   WHERE NOT EXISTS (SELECT 1 FROM items WHERE item_id = i.item_id) LIMIT 50)''')
+			for (item_id,) in conn.cursor.fetchall():
+				closure = {d['item_id']: d['count'] for d in conn.base_ingredients(item_id)}
+				recursive = {d['item_id']: d['count'] for d in conn._base_ingredients_recursive(item_id)}
+				if closure != recursive:
+					print(item_id, closure, recursive)
+
+	def unit_test3():
+		''' Both export formats write every row of a table and report the same count '''
+		import os
+		import tempfile
+		with Gw2Database() as conn:
+			conn.cursor.execute('SELECT count(*) FROM vendor_items')
+			expected = conn.cursor.fetchone()[0]
+			for fmt in ('csv', 'ndjson'):
+				file_path = os.path.join(tempfile.gettempdir(), 'vendor_items.' + fmt)
+				stats = conn.export_table('vendor_items', file_path, fmt = fmt, chunk_size = 100, verbose = True)
+				with open(file_path, 'rb') as f:
+					lines = sum(1 for line in f) - (1 if fmt == 'csv' else 0) # CSV has a header row
+				print(fmt, stats['rows'] == expected == lines, stats['bytes'] == os.path.getsize(file_path))
+
 	unit_test1()
+	unit_test2()
+	unit_test3()
 
@@ -1,42 +1,37 @@
 import json
 import paths
-from database import DatabaseConnection, Gw2Database
+import catalog
+from database import DatabaseConnection, Gw2Database, invalidate_vendor_prices
 import sys
 
-# Below are generators for parsing the api dump files into valid Python objects for insertion into database
-# May want to refactor to remove a lot of the boilerplate
+# Below are generators for parsing the api dump files into valid Python objects for insertion into database.
+# The item and recipe dumps are parsed once into the binary catalog (see catalog.build) and the
+# generators read the memory mapped catalog tables instead of re-parsing the JSON every time.
 
-# Generator for items and recipes table
+# Generator for a single JSON dump file, yields the values of args for every line
 def row_gen(file_path, *args):
 	with open(file_path) as file:
 		for line in file:
 			line = json.loads(line) # NOT json.loads(readline()) otherwise it will skip every other line
 			yield [line[arg] for arg in args]
 
-item_gen = row_gen(paths.logs + 'item_dump.txt', 'id', 'name', 'type', 'rarity')
-recipe_gen = row_gen(paths.logs + 'recipe_dump.txt', 'id', 'output_item_id', 'output_item_count')
+# Generator for any catalog table, yields the values of columns for every row
+def catalog_gen(table_name, *columns):
+	with catalog.CatalogTable(paths.catalog + table_name + '.bin') as table:
+		# Copy the values out so nothing holds a view into the map once the table is closed
+		yield from table.rows(*columns)
 
-# Generator for ingredients table, columns are recipe_id, output_item_id, output_item_count
+# Generators for items and recipes table
+item_gen = catalog_gen('items', 'item_id', 'name', 'type', 'rarity')
+recipe_gen = catalog_gen('recipes', 'recipe_id', 'item_id', 'output_count')
+
+# Generator for ingredients table, columns are recipe_id, item_id, item_count
 def ingredients_gen():
-	with open(paths.logs + 'recipe_dump.txt') as f:
-		for recipe in f:
-			recipe = json.loads(recipe)
-			ingredients = recipe['ingredients']
-			
-			# Traverse over sublist
-			for ing in ingredients: # Each value is a dictionary of form {item_id: count}
-				yield recipe['id'], ing['item_id'], ing['count']
+	return catalog_gen('ingredients', 'recipe_id', 'item_id', 'item_count')
 
 # Generator for recipe_discipline table, columns are recipe_id, discipline
 def disciplines_gen():
-	with open(paths.logs + 'recipe_dump.txt') as f:
-		for line in f:
-			line = json.loads(line)
-			disciplines = line['disciplines']
-
-			# Traverse over sublist
-			for disc in disciplines:
-				yield recipe['id'], disc
+	return catalog_gen('disciplines', 'recipe_id', 'discipline')
 
 # Generator for vendor_items table, columns are item_id, price
 def vendor_gen():
@@ -56,17 +51,17 @@ if __name__ == '__main__':
 	from utilities.log import Log
 	import datetime
 
-	def insert(generator, table_name, log_filename):
+	def insert(generator, table_name, log_filename, columns = None):
 		gw2db = Gw2Database(autocommit = True)
 		counter = 0 
 		
 		print('Inserting...')
-		log = Log(log_filename, paths.logs)
-		log.write(str(gw2db.get_columns(table_name)), end='\n\n')
+		log = Log(log_filename, paths.logs, buffered = True)
+		log.write(str(columns or gw2db.get_columns(table_name)), end='\n\n')
 		for row in generator:		
 			print(row)
 			try:
-				gw2db.insert_to_table(table_name, *row) 
+				gw2db.insert_to_table(table_name, values = row, columns = columns) 
 			except:
 				counter += 1
 				log.write(str(row))
@@ -74,7 +69,34 @@ if __name__ == '__main__':
 				log.write('--------------------------')
 		print('Done')
 		
+		if table_name == 'vendor_items':
+			# Connections in this process should not keep serving the old prices
+			invalidate_vendor_prices()
+		
 		log.write('{} rows were not inserted'.format(counter))
 		log.write('Log created {}'.format(str(datetime.datetime.now())))
+		log.close()
+
+	def load_catalog():
+		'''Parses the item and recipe dumps into the catalog, inserts the item and recipe 
+		tables from it, then recomputes the flattened recipes from the new rows'''
+		catalog.build(paths.logs + 'item_dump.txt', paths.logs + 'recipe_dump.txt', paths.catalog)
+		insert(item_gen, 'items', 'items_not_inserted.txt', ['item_id', 'name', 'type', 'rarity'])
+		insert(recipe_gen, 'recipes', 'recipes_not_inserted.txt', ['recipe_id', 'item_id', 'output_count'])
+		insert(ingredients_gen(), 'ingredients', 'ingredients_not_inserted.txt', ['recipe_id', 'item_id', 'item_count'])
+		insert(disciplines_gen(), 'recipe_discipline', 'disciplines_not_inserted.txt', ['recipe_id', 'discipline'])
+		
+		with Gw2Database() as gw2db:
+			gw2db.build_closure()
+
+	def load_vendor():
+		'''Reloads vendor prices into the catalog and the vendor_items table, the item and 
+		recipe dumps are not touched'''
+		catalog.write_vendor(paths.catalog, vendor_gen())
+		insert(vendor_gen(), 'vendor_items', 'vendored_not_inserted.txt', ['item_id', 'price', 'count'])
 
-	insert(vendor_gen(), 'vendor_items', 'vendored_not_inserted.txt')
\ No newline at end of file
+	# python dataparse.py catalog - reload items and recipes from new dumps
+	# python dataparse.py         - reload vendor prices only
+	if 'catalog' in sys.argv[1:]:
+		load_catalog()
+	load_vendor()
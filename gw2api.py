@@ -3,6 +3,8 @@ import json
 import sqlite3
 import threading
 import queue
+import paths
+from utilities.httpcache import HttpCache
 
 '''The base URL for all endpoints is https://api.guildwars2.com.  
 
@@ -13,16 +15,21 @@ a list of response objects is returned.'''
 url_v1 = 'https://api.guildwars2.com/'
 url_v2 = 'https://api.guildwars2.com/v2/'
 
+# Item and recipe definitions almost never change, so those endpoints are revalidated 
+# against a disk cache instead of being downloaded in full every time
+cache = HttpCache(paths.cache + 'gw2api.sqlite3')
+
 def v2_recipes(*recipe_ids):
 	'''If the root endpoint (/v2/recipes) is accessed without specifying an id, 
 	a list of all ids is returned. When multiple ids are requested using the ids 
 	parameter, a list of response objects is returned.'''
 	if not recipe_ids:
-		response = requests.get(url_v2 + 'recipes')
+		response = cache.get(url_v2 + 'recipes')
 		return json.loads(response.text)
 	
-	parameters = {'ids': ','.join([str(x) for x in recipe_ids])}
-	response = requests.get(url_v2 + 'recipes', params = parameters)
+	# Sorted so the same set of ids always hits the same cache entry
+	parameters = {'ids': ','.join([str(x) for x in sorted(recipe_ids)])}
+	response = cache.get(url_v2 + 'recipes', parameters)
 	return json.loads(response.text)
 
 def v2_items(*item_ids):
@@ -39,11 +46,11 @@ def v2_items(*item_ids):
 		  specified ids. Cannot be used when using the id endpoint.
 	'''
 	if not item_ids:
-		response = requests.get(url_v2 + 'items')
+		response = cache.get(url_v2 + 'items')
 		return json.loads(response.text)
 
-	parameters = {'ids': ','.join([str(x) for x in item_ids])}
-	response = requests.get(url_v2 + 'items', params = parameters)
+	parameters = {'ids': ','.join([str(x) for x in sorted(item_ids)])}
+	response = cache.get(url_v2 + 'items', parameters)
 	return json.loads(response.text)
 
 # This returns a response object
@@ -90,6 +97,26 @@ def v2_listings_sell(item_id):
 	except:
 		return 0
 
+def v2_prices(*item_ids):
+	'''Best buy order and sell listing of many items at once from /v2/commerce/prices, 
+	requested 200 ids at a time.
+	Return value: {item_id: (buy_price, sell_price), ...}, 0 where there are no orders/listings'''
+	
+	prices = {}
+	item_ids = sorted(set(item_ids))
+	for start in range(0, len(item_ids), 200):
+		parameters = {'ids': ','.join([str(x) for x in item_ids[start:start + 200]])}
+		response = requests.get(url_v2 + 'commerce/prices', params = parameters)
+		try:
+			results = json.loads(response.text)
+		except ValueError:
+			continue
+		if not isinstance(results, list):
+			continue # Error object, e.g. none of the ids are tradeable
+		for x in results:
+			prices[x['id']] = (x['buys']['unit_price'], x['sells']['unit_price'])
+	return prices
+
 # Really only use this with v2_items or v2_recipes otherwise it will throw an error
 def dump_to_file(api_func, filepath):
 	# The api only accepts 200 ids at a time
@@ -107,14 +134,17 @@ def dump_to_file(api_func, filepath):
 		stop += 200					
 
 	def worker(lock):
-		while not id_queue.empty():
-			ids = id_queue.get()
-			results = api_func(*ids)
-			
-			with open(filepath, 'a+') as dump_file:
-				for x in results:
-						with lock:
-							dump_file.write(json.dumps(x) + '\n')
+		try:
+			while not id_queue.empty():
+				ids = id_queue.get()
+				results = api_func(*ids)
+				
+				with open(filepath, 'a+') as dump_file:
+					for x in results:
+							with lock:
+								dump_file.write(json.dumps(x) + '\n')
+		finally:
+			cache.close() # Each thread opened its own cache connection
 	
 	lock = threading.Lock()
 	num_threads = id_queue.qsize()
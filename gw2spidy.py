@@ -1,9 +1,17 @@
 import requests
 import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import paths
+from utilities.httpcache import HttpCache
 
 '''Official documentation on gwspidy's api can be found at:
 https://github.com/rubensayshi/gw2spidy/wiki/API-v0.9.'''
 
+# Responses are revalidated against a disk cache, unchanged pages cost no body transfer
+cache = HttpCache(paths.cache + 'gw2spidy.sqlite3')
+
 def getTypes():
 	return genericRequest('types')
 
@@ -41,6 +49,14 @@ def getRecipes(type_id = 'all', *, page = ''):
 	'''Path - /api/{version}/{format}/recipes/{type}/{page}'''
 	return paginatedRequest('recipes', type_id, page=page,)
 
+def crawlItems(type_id='all', *, window = 8, **parameters):
+	'''Generator of every item result on every page, see paginatedCrawl'''
+	return paginatedCrawl('items', type_id, window = window, **parameters)
+
+def crawlRecipes(type_id = 'all', *, window = 8):
+	'''Generator of every recipe result on every page, see paginatedCrawl'''
+	return paginatedCrawl('recipes', type_id, window = window)
+
 def getRecipeData(recipe_id):
 	'''Can only return ONE recipe's data
 	   Path - /api/{version}/{format}/recipe/{recipe_id}'''
@@ -49,15 +65,45 @@ def getRecipeData(recipe_id):
 def genericRequest(*args, **parameters):
 	path = '/'.join([str(arg) for arg in args])
 	url = 'http://www.gw2spidy.com/api/v0.9/json/{}'.format(path)
-	response = requests.get(url, params = parameters)
+	response = cache.get(url, parameters)
 	return response
 
 def paginatedRequest(*args, page = '', **parameters):
 	'''For endpoints that can return specific pages'''
 	path = '/'.join([str(arg) for arg in args])
 	url = 'http://www.gw2spidy.com/api/v0.9/json/{}/{}'.format(path, str(page))
-	response = requests.get(url, params = parameters)
+	response = cache.get(url, parameters)
 	return response
+
+def paginatedCrawl(*args, window = 8, retries = 3, **parameters):
+	'''Generator over the 'results' of every page of a paginated endpoint, in page order.
+	The first page gives 'last_page', the rest are fetched concurrently with at most 
+	'window' requests in flight.  A failed page is retried on its own up to 'retries' times.'''
+	
+	def fetch(page):
+		for attempt in range(retries + 1):
+			try:
+				response = paginatedRequest(*args, page = page, **parameters)
+				response.raise_for_status()
+				return json.loads(response.text)
+			except (requests.RequestException, ValueError):
+				if attempt == retries:
+					raise
+				time.sleep(2 ** attempt) # Back off before retrying this page only
+	
+	first = fetch(1)
+	yield from first['results']
+	
+	last_page = first['last_page']
+	with ThreadPoolExecutor(max_workers = window) as executor:
+		pending = deque()
+		next_page = 2
+		while next_page <= last_page or pending:
+			# Keep the window full, then wait on the oldest page so results stay in order
+			while next_page <= last_page and len(pending) < window:
+				pending.append(executor.submit(fetch, next_page))
+				next_page += 1
+			yield from pending.popleft().result()['results']
 	
 if __name__ == '__main__':	
 	# Sample ids:
@@ -67,22 +113,11 @@ if __name__ == '__main__':
 	
 	
 	'''Getting all pages of recipe info'''
-	result = json.loads(getRecipes().text)	
-	total_pages = result['last_page']		# Getting the last page number
-	
 	output_file = 'all_recipes.txt'
 	with open(output_file, 'w+') as f:	
-		
-		page = 1
-		while page <= total_pages:
-			result = json.loads(getRecipes(page = page).text)
-			for x in result['results']:
-				'''Making each result database friendly'''
-				x = (x['data_id'], x['name'], x['result_count'], x['result_item_data_id'])
-				x = [str(item) for item in x]
-				x[1] = repr(x[1])			# Some items have quotes in them
-				f.write(','.join(x) + '\n')	
-			
-			print('page {} finished'.format(page))
-			page += 1
-
+		for x in crawlRecipes():
+			'''Making each result database friendly'''
+			x = (x['data_id'], x['name'], x['result_count'], x['result_item_data_id'])
+			x = [str(item) for item in x]
+			x[1] = repr(x[1])			# Some items have quotes in them
+			f.write(','.join(x) + '\n')
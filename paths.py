@@ -21,8 +21,16 @@ root = fullpath('')
 
 watchlists = fullpath('watchlists')
 
+# Path of the binary catalog built from the api dumps (see catalog.py)
+catalog = fullpath('catalog')
+
+# Path of the on-disk cache for static api responses (see utilities/httpcache.py)
+cache = fullpath('cache')
+
 if __name__ == '__main__':
 	print(__file__)
 	print(logs)
 	print(database)
 	print(watchlists)
+	print(catalog)
+	print(cache)
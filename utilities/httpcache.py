@@ -0,0 +1,149 @@
+''' Contains the HttpCache class, an on-disk cache for GET requests to endpoints whose data rarely
+changes (item and recipe definitions, gw2spidy pages).  Cached responses are revalidated with
+conditional requests, so an unchanged resource costs a 304 with no body.
+
+Entries live in a SQLite database, which makes the cache safe to share between threads and
+between processes.  The total size of stored bodies is capped and the least recently used
+entries are evicted first.'''
+
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import urlencode
+
+import requests
+
+class HttpCache:
+	def __init__(self, path, max_bytes = 256 * 1024 * 1024):
+		self.path = path
+		self.max_bytes = max_bytes
+		self._local = threading.local() # sqlite3 connections cannot be shared across threads
+
+	def _connection(self):
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			os.makedirs(os.path.dirname(self.path) or '.', exist_ok = True)
+			# Autocommit mode, the timeout makes concurrent writers wait on the lock instead of failing
+			connection = sqlite3.connect(self.path, timeout = 30, isolation_level = None)
+			connection.execute('PRAGMA journal_mode = WAL')
+			connection.executescript(self._schema)
+			self._local.connection = connection
+		return connection
+
+	# body is the last column so reading size/last_access never walks a row's overflow pages.
+	# The triggers keep the total size of all bodies in cache_size, so eviction does not 
+	# have to scan the table to know whether it is over the cap.
+	_schema = '''
+		CREATE TABLE IF NOT EXISTS responses (
+			key TEXT PRIMARY KEY,
+			etag TEXT,
+			last_modified TEXT,
+			encoding TEXT,
+			size INTEGER NOT NULL,
+			last_access REAL NOT NULL,
+			body BLOB NOT NULL);
+		CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access);
+		CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL);
+		INSERT OR IGNORE INTO cache_size VALUES (0, 0);
+		CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+			BEGIN UPDATE cache_size SET total = total + NEW.size; END;
+		CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+			BEGIN UPDATE cache_size SET total = total - OLD.size; END;'''
+
+	def close(self):
+		'''Closes the calling thread's connection, threads that used the cache should call 
+		this before they exit'''
+		connection = getattr(self._local, 'connection', None)
+		if connection is not None:
+			connection.close()
+			self._local.connection = None
+
+	@staticmethod
+	def key(url, params = None):
+		'''Cache key for a request, parameters are sorted so their order does not matter'''
+		if not params:
+			return url
+		return url + '?' + urlencode(sorted(params.items()))
+
+	def get(self, url, params = None):
+		'''Same as requests.get(url, params = params), but answered from the cache when the
+		server reports the stored copy is still current.  Returns a requests.Response.'''
+
+		key = self.key(url, params)
+		connection = self._connection()
+		cached = connection.execute('SELECT etag, last_modified, encoding, body FROM responses WHERE key = ?',
+									(key,)).fetchone()
+
+		headers = {}
+		if cached is not None:
+			etag, last_modified = cached[0], cached[1]
+			if etag:
+				headers['If-None-Match'] = etag
+			if last_modified:
+				headers['If-Modified-Since'] = last_modified
+
+		response = requests.get(url, params = params, headers = headers)
+
+		if response.status_code == 304 and cached is not None:
+			# Not modified, serve the stored body as if it had been sent again
+			response.status_code = 200
+			response.encoding = cached[2]
+			response._content = cached[3]
+			connection.execute('UPDATE responses SET last_access = ? WHERE key = ?', (time.time(), key))
+			return response
+
+		etag = response.headers.get('ETag')
+		last_modified = response.headers.get('Last-Modified')
+		if response.status_code == 200 and (etag or last_modified):
+			self._store(key, etag, last_modified, response.encoding, response.content)
+		return response
+
+	def _store(self, key, etag, last_modified, encoding, body):
+		connection = self._connection()
+		connection.execute('BEGIN IMMEDIATE')
+		try:
+			# Delete then insert (not INSERT OR REPLACE) so the triggers see the old size leave
+			connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+			connection.execute('''INSERT INTO responses
+					(key, etag, last_modified, encoding, size, last_access, body)
+					VALUES (?, ?, ?, ?, ?, ?, ?)''',
+					(key, etag, last_modified, encoding, len(body), time.time(), body))
+			connection.execute('COMMIT')
+		except:
+			connection.execute('ROLLBACK')
+			raise
+		self.evict()
+
+	def evict(self):
+		'''Deletes the least recently used entries until stored bodies fit in max_bytes'''
+		connection = self._connection()
+		if connection.execute('SELECT total FROM cache_size').fetchone()[0] <= self.max_bytes:
+			return
+
+		connection.execute('BEGIN IMMEDIATE')
+		try:
+			excess = connection.execute('SELECT total FROM cache_size').fetchone()[0] - self.max_bytes
+			oldest = connection.execute('SELECT key, size FROM responses ORDER BY last_access')
+			victims = []
+			for key, size in oldest:
+				if excess <= 0:
+					break
+				victims.append((key,))
+				excess -= size
+			oldest.close()
+			connection.executemany('DELETE FROM responses WHERE key = ?', victims)
+			connection.execute('COMMIT')
+		except:
+			connection.execute('ROLLBACK')
+			raise
+
+	def clear(self):
+		self._connection().execute('DELETE FROM responses')
+
+if __name__ == '__main__':
+	cache = HttpCache('testcache.sqlite3')
+	for i in range(2):
+		start = time.time()
+		response = cache.get('https://api.guildwars2.com/v2/items', {'ids': '19924,82796'})
+		print(response.status_code, len(response.content), time.time() - start)
@@ -3,10 +3,22 @@ deal with file paths and context managers'''
 
 import os
 import sys
+import time
+import atexit
+import threading
+from queue import Queue, Empty
 
 class Log:
+	# Most items the writer thread takes off the queue before writing, so a steady stream
+	# of writes cannot keep it collecting forever
+	batch_size = 1000
+
 	# If no path is provided this class will create the log file in the same directory as the top level script
-	def __init__(self, filename, folder_path=0):
+	def __init__(self, filename, folder_path=0, *, buffered=False, flush_interval=1.0, max_bytes=0, backup_count=3):
+		'''buffered - hand writes to a background thread that appends them in batches,
+					  flushing at least every flush_interval seconds and always on exit
+		   max_bytes - (buffered only) a write that would take the file past max_bytes first renames
+					   it to <path>.1 (older copies shift up to <path>.<backup_count>) and starts a new file'''
 		self.filename = filename
 		
 		#If a specific folder path is provided
@@ -20,10 +32,107 @@ class Log:
 		# Create a blank log file
 		with open(self.path, 'w+') as f:
 			pass
+
+		self.flush_interval = flush_interval
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self._queue = None
+		self._lock = threading.Lock() # Guards _queue, so no write can land behind close()'s sentinel
+
+		if buffered:
+			self._queue = Queue()
+			self._thread = threading.Thread(target = self._writer, args = (self._queue,), daemon = True)
+			self._thread.start()
+			atexit.register(self.close) # Daemon threads are killed at exit, so drain the queue first
 	
 	def write(self, string, end='\n'):
-		with open(self.path, 'a+') as f:
-			f.write(string + end)
+		with self._lock:
+			if self._queue is not None:
+				self._queue.put(string + end)
+				return
+			with open(self.path, 'a+') as f:
+				f.write(string + end)
+
+	def flush(self):
+		'''Blocks until everything written so far is on disk (no-op when unbuffered)'''
+		done = threading.Event()
+		with self._lock:
+			if self._queue is None or not self._thread.is_alive():
+				return
+			self._queue.put(done)
+		done.wait()
+
+	def close(self):
+		'''Flushes and stops the writer thread, later writes go straight to the file'''
+		with self._lock:
+			queue, self._queue = self._queue, None
+			if queue is None:
+				return
+			# Writes racing close() wait on the lock until the queue is drained, then append directly
+			queue.put(None)
+			self._thread.join()
+		atexit.unregister(self.close)
+
+	def _rotate(self):
+		for i in range(self.backup_count - 1, 0, -1):
+			if os.path.exists('{}.{}'.format(self.path, i)):
+				os.replace('{}.{}'.format(self.path, i), '{}.{}'.format(self.path, i + 1))
+		if self.backup_count > 0:
+			os.replace(self.path, self.path + '.1')
+		else:
+			os.remove(self.path)
+
+	def _writer(self, queue):
+		'''Runs on the background thread.  Takes up to batch_size queued items, writes them in as
+		few calls as rotation allows, and flushes when the queue goes idle or flush_interval 
+		has passed.'''
+		f = open(self.path, 'a+', encoding = 'utf-8')
+		size = f.tell()
+		last_flush = time.time()
+		running = True
+
+		while running:
+			try:
+				batch = [queue.get(timeout = self.flush_interval)]
+			except Empty:
+				f.flush()
+				last_flush = time.time()
+				continue
+
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(queue.get_nowait())
+				except Empty:
+					break
+
+			# Items are strings, a None sentinel (close) or an Event waiting on a flush
+			pending = []
+			for item in batch:
+				if not isinstance(item, str):
+					continue
+				length = len(item.encode('utf-8'))
+				# Rotate before a line that would overshoot, a single oversized line still gets a file
+				if self.max_bytes and size and size + length > self.max_bytes:
+					f.write(''.join(pending))
+					pending = []
+					f.close()
+					self._rotate()
+					f = open(self.path, 'a+', encoding = 'utf-8')
+					size = 0
+				pending.append(item)
+				size += length
+			f.write(''.join(pending))
+
+			events = [item for item in batch if isinstance(item, threading.Event)]
+			running = None not in batch
+
+			if events or not running or time.time() - last_flush >= self.flush_interval:
+				f.flush()
+				last_flush = time.time()
+			for event in events:
+				event.set()
+
+		f.close()
 
 if __name__ == '__main__':
 	import datetime
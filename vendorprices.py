@@ -0,0 +1,39 @@
+''' Contains the VendorPrices class, the compact in-memory form of the vendor_items table shared by
+catalog.Catalog and database.Gw2Database'''
+
+from array import array
+from bisect import bisect_left
+
+class VendorPrices:
+	'''Read only map of item_id -> (price, count) for the vendor_items table, kept as three
+	parallel int arrays sorted by item_id.'''
+	def __init__(self, rows):
+		# Stable sort, so the first row of a duplicated item_id wins like fetchone()
+		rows = sorted(rows, key = lambda row: row[0])
+		self.item_ids = array('i', [row[0] for row in rows])
+		self.prices = array('i', [row[1] for row in rows])
+		self.counts = array('i', [row[2] for row in rows])
+
+	def __len__(self):
+		return len(self.item_ids)
+
+	def __contains__(self, item_id):
+		return self._index(item_id) is not None
+
+	def _index(self, item_id):
+		if item_id is None:
+			return None
+		i = bisect_left(self.item_ids, item_id)
+		if i < len(self.item_ids) and self.item_ids[i] == item_id:
+			return i
+		return None
+
+	def get(self, item_id, default = None):
+		'''Returns (price, count), or default when the item is not sold by vendors'''
+		i = self._index(item_id)
+		return default if i is None else (self.prices[i], self.counts[i])
+
+	def price(self, item_id):
+		'''Returns the price, or None when the item is not sold by vendors'''
+		i = self._index(item_id)
+		return None if i is None else self.prices[i]